@@ -1,45 +1,112 @@
 #!/usr/bin/env python3
 
+import argparse
+import functools
+import hashlib
+import json
+import os
+import shlex
 import subprocess
+import tempfile
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 
-clang_versions = list(range(7, 15 + 1))
-gcc_versions = list(range(7, 11 + 1))
-nvcc_versions = ["11.7.1", "11.8.0"]
-nvhpc_versions = [
-    { "hpc_ver": "22.7", "cuda_ver": "11.7"},
-    { "hpc_ver": "22.7", "cuda_ver": "_multi"},
-    { "hpc_ver": "22.9", "cuda_ver": "11.7"},
-    { "hpc_ver": "22.9", "cuda_ver": "_multi"},
-]
+# The build matrix: for each ubuntu version, the compiler/CUDA/NVHPC versions to
+# build on top of it. Can be overridden with --matrix pointing to a JSON file of
+# the same shape.
+ubuntu_versions = {
+    "20.04": {
+        "clang_versions": list(range(7, 15 + 1)),
+        "gcc_versions": list(range(7, 11 + 1)),
+        "nvcc_versions": ["11.7.1", "11.8.0"],
+        "nvhpc_versions": [
+            { "hpc_ver": "22.7", "cuda_ver": "11.7"},
+            { "hpc_ver": "22.7", "cuda_ver": "_multi"},
+            { "hpc_ver": "22.9", "cuda_ver": "11.7"},
+            { "hpc_ver": "22.9", "cuda_ver": "_multi"},
+        ],
+    },
+    "22.04": {
+        "clang_versions": list(range(11, 15 + 1)),
+        "gcc_versions": list(range(9, 12 + 1)),
+        "nvcc_versions": ["11.7.1", "11.8.0"],
+        "nvhpc_versions": [
+            { "hpc_ver": "22.9", "cuda_ver": "11.7"},
+            { "hpc_ver": "22.9", "cuda_ver": "_multi"},
+        ],
+    },
+}
+
+# The ubuntu version whose images keep the historical unsuffixed names
+default_ubuntu = "20.04"
+
+# The CMake version baked into the shared helper image and copied into every base
+cmake_version = "3.24.1"
+
+# Helper image that downloads CMake once; the base images COPY it from here
+# instead of each pulling it from the kitware apt repository
+cmake_dockerfile = """# syntax=docker/dockerfile:1.4
+FROM ubuntu:22.04 AS dl
+
+ARG DEBIAN_FRONTEND=noninteractive
+ARG CMAKE_VERSION={cmake_version}
+RUN set -xe; \\
+    apt-get -y update; \\
+    apt-get -y install --no-install-recommends ca-certificates wget; \\
+    mkdir -p /opt/cmake; \\
+    wget -qO- https://github.com/Kitware/CMake/releases/download/v${{CMAKE_VERSION}}/cmake-${{CMAKE_VERSION}}-linux-$(uname -m).tar.gz \\
+        | tar xz --strip-components=1 -C /opt/cmake
+
+FROM scratch
+COPY --from=dl /opt/cmake /
+"""
 
 prologue = """
 
 ARG DEBIAN_FRONTEND=noninteractive
-ARG CMAKE_VERSION=3.24.1-0kitware1ubuntu20.04.1
+"""
+
+# Prologue for the per-compiler Dockerfiles; they only run apt, so they don't
+# need the CMake version
+compiler_prologue = """
+
+ARG DEBIAN_FRONTEND=noninteractive
 """
 
 install_base = """
-# Common package setup
-RUN set -xe; \\
+# Keep downloaded packages around; the BuildKit cache mounts reuse them across builds
+RUN rm -f /etc/apt/apt.conf.d/docker-clean; \\
+    echo 'Binary::apt::APT::Keep-Downloaded-Packages "true";' > /etc/apt/apt.conf.d/keep-cache
+
+# Common package setup; the least volatile layer comes first, so the version
+# bumps below don't invalidate it. The shared build tools come from a
+# bind-mounted manifest, so the RUN text stays identical across all variants.
+# The apt cache mounts carry an explicit id: without one BuildKit keys the
+# cache by target path, and sharing=locked would then serialize the apt step
+# of every image in the matrix behind a single global lock
+RUN --mount=type=bind,source=script/apt-packages-common.txt,target=/tmp/apt-common.txt \\
+    --mount=type=cache,id=apt-cache-{variant},target=/var/cache/apt,sharing=locked \\
+    --mount=type=cache,id=apt-lists-{variant},target=/var/lib/apt/lists,sharing=locked \\
+    set -xe; \\
     # Install pacakges to allow us to install other packages
     apt-get -y update; \\
     apt-get -y install --no-install-recommends \\
-        apt-transport-https ca-certificates gnupg software-properties-common wget; \\
-    # Add kiware repository for CMake
-    wget -O - https://apt.kitware.com/keys/kitware-archive-latest.asc 2>/dev/null | apt-key add -; \\
-    apt-add-repository -y -n 'https://apt.kitware.com/ubuntu/'; \\
-    apt-add-repository -y -n 'ppa:ubuntu-toolchain-r/test'; \\
+        apt-transport-https ca-certificates gnupg wget; \\
+    # Add the ubuntu-toolchain-r PPA, with its key as a dedicated keyring file
+    install -d /etc/apt/keyrings; \\
+    wget -qO- 'https://keyserver.ubuntu.com/pks/lookup?op=get&search=0x60C317803A41BA51845E371A1E9377A2BA9EF27F' \\
+        | gpg --dearmor -o /etc/apt/keyrings/toolchain-r.gpg; \\
+    echo "deb [signed-by=/etc/apt/keyrings/toolchain-r.gpg] https://ppa.launchpadcontent.net/ubuntu-toolchain-r/test/ubuntu $(. /etc/os-release && echo $VERSION_CODENAME) main" \\
+        > /etc/apt/sources.list.d/ubuntu-toolchain-r.list; \\
     apt-get -y update; \\
     # Install generic build tools & python
-    apt-get -y install --no-install-recommends \\
-        pkg-config make \\
-        cmake=$CMAKE_VERSION \\
-        cmake-data=$CMAKE_VERSION \\
-        python3 python3-pip python3-setuptools \\
-        ; \\
-    # Cleanup apt packages
-    rm -rf /var/lib/apt/lists/*; \\
-    # Install conan
+    xargs -a /tmp/apt-common.txt apt-get -y install --no-install-recommends
+
+# Install CMake from the prebuilt helper image; it is downloaded once, and a
+# version bump only invalidates the layers from here on
+COPY --from=action-cxx-cmake:{cmake_version} / /usr/local/
+
+# Install conan
+RUN --mount=type=cache,target=/root/.cache/pip \\
     python3 -m pip install conan
 """
 
@@ -50,32 +117,45 @@ ENTRYPOINT ["/usr/local/bin/entrypoint.py"]
 """
 
 
+def _print_cmd(args):
+    """Log a command the way the shell would accept it back"""
+    print(" ".join(shlex.quote(a) for a in args))
+
+
 def _gen_alternatives(alts):
     """Generate alternatives strings; takes in a list of pairs (alias-name, actual-name)"""
-    res = ""
-    for (alias, actual) in alts:
+    parts = []
+    for i, (alias, actual) in enumerate(alts):
         rule = f"/usr/bin/{alias} {alias} {actual}"
-        if not res:
-            res = f"update-alternatives --install {rule} 100 "
+        if i == 0:
+            parts.append(f"update-alternatives --install {rule} 100 ")
         else:
-            res += f" \\\n        --slave {rule}"
-    return res
+            parts.append(f" \\\n        --slave {rule}")
+    return "".join(parts)
 
 
-def _get_compiler_text(compilers, extra_packages=""):
-    """Get the text to install the compilers and tools. `compilers` param is a dictionary: name -> ver"""
+@functools.lru_cache(maxsize=None)
+def _get_compiler_text(compilers, extra_packages="", cache_id=""):
+    """Get the text to install the compilers and tools. `compilers` param is a tuple of
+    (name, ver) pairs, so identical compiler sets share one cached result across the
+    CUDA/NVHPC variants. `cache_id` keys the apt cache mounts per ubuntu release, so
+    only builds that share package indexes contend on the same cache lock."""
+    compilers = dict(compilers)
     assert "clang" in compilers or "gcc" in compilers
     alts = []
     pre_install = ""
-    packages = ""
+    packages = []
 
     if "clang" in compilers:
         v = compilers["clang"]
         llvm_dev_ver = v if v > 13 else 13
-        pre_install = f"""wget -qO - https://apt.llvm.org/llvm-snapshot.gpg.key | apt-key add -; \\
-    apt-add-repository -y -n "deb http://apt.llvm.org/$(lsb_release -cs)/ llvm-toolchain-$(lsb_release -cs)-{llvm_dev_ver} main"; \\
+        pre_install = f"""install -d /etc/apt/keyrings; \\
+    wget -qO- https://apt.llvm.org/llvm-snapshot.gpg.key | gpg --dearmor -o /etc/apt/keyrings/llvm.gpg; \\
+    codename=$(. /etc/os-release && echo $VERSION_CODENAME); \\
+    echo "deb [signed-by=/etc/apt/keyrings/llvm.gpg] http://apt.llvm.org/$codename/ llvm-toolchain-$codename-{llvm_dev_ver} main" \\
+        > /etc/apt/sources.list.d/llvm.list; \\
 """
-        packages = f"clang++-{v} libc++-{v}-dev libc++abi-{v}-dev clang-tidy-{v} clang-format-{v}"
+        packages.append(f"clang++-{v} libc++-{v}-dev libc++abi-{v}-dev clang-tidy-{v} clang-format-{v}")
         alts = [
             ("clang", f"/usr/bin/clang-{v}"),
             ("clang-format", f"/usr/bin/clang-format-{v}"),
@@ -93,7 +173,7 @@ def _get_compiler_text(compilers, extra_packages=""):
 
     if "gcc" in compilers:
         v = compilers["gcc"]
-        packages += f" g++-{v}"
+        packages.append(f"g++-{v}")
         alts.extend(
             [
                 ("gcc", f"/usr/bin/gcc-{v}"),
@@ -102,124 +182,329 @@ def _get_compiler_text(compilers, extra_packages=""):
         )
 
     if extra_packages:
-        packages += f" {extra_packages}"
+        packages.append(extra_packages)
 
     return f"""
 # Clang and tools
-RUN set -xe; \\
+RUN --mount=type=cache,id=apt-cache-{cache_id},target=/var/cache/apt,sharing=locked \\
+    --mount=type=cache,id=apt-lists-{cache_id},target=/var/lib/apt/lists,sharing=locked \\
+    set -xe; \\
     {pre_install} \\
     apt-get -y update; \\
     apt-get -y install --no-install-recommends \\
-        {packages} \\
-    ; \\
-    rm -rf /var/lib/apt/lists/*; \\
-    {_gen_alternatives(alts)}
+        {" ".join(packages)}
+
+# Register the compiler aliases; own layer, so alias changes don't re-run apt
+RUN {_gen_alternatives(alts)}
 """
 
 
-def generate_docker(filename, base_image, compilers, extra_packages=""):
-    with open(filename, "w") as f:
-        f.write(f"FROM {base_image}")
-        f.write(prologue)
-        f.write(install_base)
-        f.write(_get_compiler_text(compilers, extra_packages))
-        f.write(epilogue)
+def _write_dockerfile(filename, *sections):
+    """Write the file with a single write via a temp file + rename, so an
+    interrupted run never leaves a partially written Dockerfile behind. When the
+    file already has the wanted content, leave it (and its mtime) alone, so the
+    docker build cache doesn't see an unchanged Dockerfile as modified."""
+    content = "".join(sections)
+    digest = hashlib.blake2b(content.encode()).digest()
+    try:
+        with open(filename, "rb") as f:
+            if hashlib.blake2b(f.read()).digest() == digest:
+                return
+    except OSError:
+        pass
+    with tempfile.NamedTemporaryFile(
+        "w", dir=os.path.dirname(filename) or ".", delete=False
+    ) as f:
+        f.write(content)
+    os.replace(f.name, filename)
+
+
+# Cache of tag -> digest resolutions, so re-runs within a pipeline don't
+# re-query the registry
+_digest_cache_file = ".image-digests.json"
+
+
+def _resolve_digests(images):
+    """Resolve floating image tags to digest-pinned references (image@sha256:...),
+    so the builds skip the per-tag registry probes and stay reproducible. Returns
+    a dict image -> pinned reference; tags that cannot be resolved (offline, not
+    published yet) are kept as-is."""
+    try:
+        with open(_digest_cache_file) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    resolved = {}
+    for image in images:
+        digest = cache.get(image)
+        if not digest:
+            cmd = ["docker", "buildx", "imagetools", "inspect",
+                   "--format", "{{.Manifest.Digest}}", image]
+            try:
+                digest = subprocess.check_output(cmd, text=True).strip()
+            except (OSError, subprocess.CalledProcessError):
+                digest = ""
+        if digest:
+            cache[image] = digest
+            resolved[image] = f"{image}@{digest}"
+        else:
+            resolved[image] = image
+    with open(_digest_cache_file, "w") as f:
+        json.dump(cache, f, indent=2)
+    return resolved
+
+
+def generate_base_docker(filename, base_image, cmake_version, variant):
+    """Generate a Dockerfile with the common base setup; all the per-compiler
+    images derive from the image built from this, so the expensive apt/CMake/conan
+    layers are computed only once per base variant. `variant` discriminates the
+    apt cache mounts, so concurrent base builds don't contend on one lock."""
+    _write_dockerfile(
+        filename,
+        "# syntax=docker/dockerfile:1.4\n",
+        f"FROM {base_image}",
+        prologue,
+        install_base.format(cmake_version=cmake_version, variant=variant),
+    )
+
+
+def generate_docker(filename, base_variant, compilers, extra_packages=""):
+    """Generate the Dockerfile for one per-compiler image.
+
+    The images are deliberately single-stage: their job at runtime is to compile
+    user code, so the final image needs the full toolchain, headers and a working
+    apt (entrypoint.py installs the requested dependencies with apt-get). A slim
+    COPY --from runtime stage would have to carry all of that anyway. The things
+    a multi-stage split would strip (apt lists, deb/wheel caches) already stay
+    out of the layers via the BuildKit cache mounts."""
+    # Key the apt caches by ubuntu release (the variant suffix), not the full
+    # base variant: the CUDA/NVHPC siblings can still share one memoized text
+    # and one cache, while the two ubuntu families no longer lock each other out
+    compiler_text = _get_compiler_text(
+        tuple(sorted(compilers.items())), extra_packages, base_variant.split("-")[-1]
+    )
+    _write_dockerfile(
+        filename,
+        "# syntax=docker/dockerfile:1.4\n",
+        f"FROM action-cxx-base:{base_variant}",
+        compiler_prologue,
+        compiler_text,
+        epilogue,
+    )
 
 
 def main():
-    # Generate the main docker file
-    generate_docker(
-        "Dockerfile.main",
-        "ubuntu:20.04",
-        {"clang": clang_versions[-1], "gcc": gcc_versions[-1]},
-        "curl git cppcheck iwyu lcov",
+    parser = argparse.ArgumentParser(
+        description="Generate and build the docker images for all the configured toolchains"
     )
-    # Generate the clang docker files
-    for v in clang_versions:
-        generate_docker(f"Dockerfile.clang{v}", "ubuntu:20.04", {"clang": v})
-    # Generate the gcc docker files
-    for v in gcc_versions:
-        generate_docker(f"Dockerfile.gcc{v}", "ubuntu:20.04", {"gcc": v})
-        # Generate gcc + CUDA dockerfiles
+    parser.add_argument(
+        "--matrix",
+        metavar="FILE",
+        help="JSON file with the ubuntu -> compiler versions build matrix; "
+        "defaults to the matrix embedded in this script",
+    )
+    args = parser.parse_args()
+    matrix = ubuntu_versions
+    if args.matrix:
+        with open(args.matrix) as f:
+            matrix = json.load(f)
+
+    # The base image variants; each per-compiler Dockerfile derives from one of
+    # these, so the install_base layers are built once and shared
+    base_variants = {}  # variant name -> base image
+    # The per-compiler services, mapped to the base variant each one derives from
+    compiler_services = {}
+    # The services belonging to each ubuntu version, for selective bake builds
+    service_groups = {}
+    # The docker files to generate; the writes are independent, so they are
+    # dispatched on a thread pool below
+    gen_tasks = []
+
+    for ubuntu_version, cfg in matrix.items():
+        clang_versions, gcc_versions, nvcc_versions, nvhpc_versions = (
+            cfg[k] for k in ("clang_versions", "gcc_versions", "nvcc_versions", "nvhpc_versions")
+        )
+        ubuntu_variant = f"ubuntu{ubuntu_version}"
+        # The default ubuntu version keeps the historical unsuffixed image names;
+        # the other versions get an explicit -ubuntuXX.YY suffix
+        suffix = "" if ubuntu_version == default_ubuntu else f"-{ubuntu_variant}"
+
+        base_variants[ubuntu_variant] = f"ubuntu:{ubuntu_version}"
         for cuda_ver in nvcc_versions:
-            generate_docker(
-                f"Dockerfile.gcc{v}-cuda{cuda_ver}",
-                f"nvidia/cuda:{cuda_ver}-devel-ubuntu20.04",
-                {"gcc": v}
-            )
-        # Generate gcc + NVHPC dockerfiles
+            base_variants[f"cuda{cuda_ver}-{ubuntu_variant}"] = \
+                f"nvidia/cuda:{cuda_ver}-devel-ubuntu{ubuntu_version}"
         for nvhpc_ver in nvhpc_versions:
             hpc_ver = nvhpc_ver["hpc_ver"]
             cuda_ver = nvhpc_ver["cuda_ver"]
-            generate_docker(
-                f"Dockerfile.gcc{v}-cuda{cuda_ver}-nvhpc{hpc_ver}",
-                f"nvcr.io/nvidia/nvhpc:{hpc_ver}-devel-cuda{cuda_ver}-ubuntu20.04",
-                {"gcc": v}
-            )
+            base_variants[f"cuda{cuda_ver}-nvhpc{hpc_ver}-{ubuntu_variant}"] = \
+                f"nvcr.io/nvidia/nvhpc:{hpc_ver}-devel-cuda{cuda_ver}-ubuntu{ubuntu_version}"
 
-    with open("docker-compose.yml", "w") as f:
-        f.write("services:\n")
-        f.write("""
-  main:
-    image: lucteo/action-cxx-toolkit.main
-    build:
-      context: .
-      dockerfile: Dockerfile.main
-""")
+        # The main docker file
+        compiler_services[f"main{suffix}"] = ubuntu_variant
+        gen_tasks.append((
+            generate_docker,
+            f"Dockerfile.main{suffix}",
+            ubuntu_variant,
+            {"clang": clang_versions[-1], "gcc": gcc_versions[-1]},
+            "curl git cppcheck iwyu lcov",
+        ))
+        # The clang docker files
         for v in clang_versions:
-            f.write(f"""
-  clang{v}:
-    image: lucteo/action-cxx-toolkit.clang{v}
-    build:
-      context: .
-      dockerfile: Dockerfile.clang{v}
-""")
+            compiler_services[f"clang{v}{suffix}"] = ubuntu_variant
+            gen_tasks.append((
+                generate_docker, f"Dockerfile.clang{v}{suffix}", ubuntu_variant, {"clang": v}
+            ))
+        # The gcc docker files
         for v in gcc_versions:
-            f.write(f"""
-  gcc{v}:
-    image: lucteo/action-cxx-toolkit.gcc{v}
-    build:
-      context: .
-      dockerfile: Dockerfile.gcc{v}
-""")
+            compiler_services[f"gcc{v}{suffix}"] = ubuntu_variant
+            gen_tasks.append((
+                generate_docker, f"Dockerfile.gcc{v}{suffix}", ubuntu_variant, {"gcc": v}
+            ))
+            # gcc + CUDA dockerfiles
             for cuda_ver in nvcc_versions:
-                f.write(f"""
-  gcc{v}-cuda{cuda_ver}:
-    image: lucteo/action-cxx-toolkit.gcc{v}-cuda{cuda_ver}
-    build:
-      context: .
-      dockerfile: Dockerfile.gcc{v}-cuda{cuda_ver}
-""")
+                variant = f"cuda{cuda_ver}-{ubuntu_variant}"
+                compiler_services[f"gcc{v}-cuda{cuda_ver}{suffix}"] = variant
+                gen_tasks.append((
+                    generate_docker, f"Dockerfile.gcc{v}-cuda{cuda_ver}{suffix}", variant, {"gcc": v}
+                ))
+            # gcc + NVHPC dockerfiles
             for nvhpc_ver in nvhpc_versions:
                 hpc_ver = nvhpc_ver["hpc_ver"]
                 cuda_ver = nvhpc_ver["cuda_ver"]
-                f.write(f"""
-  gcc{v}-cuda{cuda_ver}-nvhpc{hpc_ver}:
-    image: lucteo/action-cxx-toolkit.gcc{v}-cuda{cuda_ver}-nvhpc{hpc_ver}
+                variant = f"cuda{cuda_ver}-nvhpc{hpc_ver}-{ubuntu_variant}"
+                compiler_services[f"gcc{v}-cuda{cuda_ver}-nvhpc{hpc_ver}{suffix}"] = variant
+                gen_tasks.append((
+                    generate_docker,
+                    f"Dockerfile.gcc{v}-cuda{cuda_ver}-nvhpc{hpc_ver}{suffix}",
+                    variant,
+                    {"gcc": v},
+                ))
+
+        service_groups[ubuntu_version] = [
+            s for s, var in compiler_services.items() if var.endswith(ubuntu_variant)
+        ]
+
+    # The shared CMake helper image
+    gen_tasks.append((
+        _write_dockerfile, "Dockerfile.cmake", cmake_dockerfile.format(cmake_version=cmake_version)
+    ))
+    # The base docker files, with their FROM references pinned to digests
+    pinned = _resolve_digests(list(base_variants.values()))
+    for variant, base_image in base_variants.items():
+        gen_tasks.append((
+            generate_base_docker, f"Dockerfile.base-{variant}", pinned[base_image],
+            cmake_version, variant
+        ))
+
+    with ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 4) as ex:
+        # Force the lazy map, so generation errors surface here
+        list(ex.map(lambda task: task[0](*task[1:]), gen_tasks))
+
+    # The shared build settings are emitted once as a YAML anchor and merged into
+    # each service, instead of repeating them ~80 times. Only the publishable
+    # lucteo/ images go in here: building happens through the bake file (whose
+    # contexts already order the bases before their dependents), and the compose
+    # file only remains so `docker-compose push` in uploadall.sh keeps working.
+    # The local-only action-cxx-base images must not appear, or a blanket push
+    # would try docker.io/library/action-cxx-base and abort the upload.
+    compose_parts = ["""x-build-defaults: &build-defaults
+  context: .
+  args:
+    BUILDKIT_INLINE_CACHE: "1"
+
+services:
+"""]
+    for service in compiler_services:
+        compose_parts.append(f"""
+  {service}:
+    image: lucteo/action-cxx-toolkit.{service}
     build:
-      context: .
-      dockerfile: Dockerfile.gcc{v}-cuda{cuda_ver}-nvhpc{hpc_ver}
+      <<: *build-defaults
+      dockerfile: Dockerfile.{service}
+      cache_from:
+        - lucteo/action-cxx-toolkit.{service}
+""")
+    with open("docker-compose.yml", "w") as f:
+        f.write("".join(compose_parts))
+
+    # Emit the buildx bake file; one bake invocation builds the whole matrix as a
+    # single DAG, so the base images and registry pulls are shared across groups.
+    # Bake target names cannot contain dots, hence the sanitization.
+    def bake_name(service):
+        return service.replace(".", "_")
+
+    with open("docker-bake.hcl", "w") as f:
+        all_targets = ", ".join([f'"{bake_name(s)}"' for s in compiler_services])
+        f.write(f"""group "default" {{
+  targets = [{all_targets}]
+}}
+""")
+        for ubuntu_version, services in service_groups.items():
+            targets = ", ".join([f'"{bake_name(s)}"' for s in services])
+            f.write(f"""
+group "{bake_name(f"ubuntu{ubuntu_version}")}" {{
+  targets = [{targets}]
+}}
+""")
+        f.write(f"""
+target "cmake" {{
+  dockerfile = "Dockerfile.cmake"
+  tags = ["action-cxx-cmake:{cmake_version}"]
+}}
 """)
+        for variant in base_variants:
+            f.write(f"""
+target "{bake_name(f"base-{variant}")}" {{
+  dockerfile = "Dockerfile.base-{variant}"
+  tags = ["action-cxx-base:{variant}"]
+  contexts = {{ "action-cxx-cmake:{cmake_version}" = "target:cmake" }}
+}}
+""")
+        for service, variant in compiler_services.items():
+            f.write(f"""
+target "{bake_name(service)}" {{
+  dockerfile = "Dockerfile.{service}"
+  tags = ["lucteo/action-cxx-toolkit.{service}"]
+  cache-from = ["lucteo/action-cxx-toolkit.{service}"]
+  cache-to = ["type=inline"]
+  contexts = {{ "action-cxx-base:{variant}" = "target:{bake_name(f"base-{variant}")}" }}
+}}
+""")
+
+    # Prime the layer cache from the previously published images; without this a
+    # fresh CI daemon rebuilds every layer even when nothing changed. The pulls
+    # are independent and network-bound, so they run concurrently and we wait for
+    # all of them before building
+    procs = []
+    for service in compiler_services:
+        cmd = ["docker", "pull", f"lucteo/action-cxx-toolkit.{service}"]
+        _print_cmd(cmd)
+        procs.append(subprocess.Popen(cmd))
+    for p in procs:
+        # A failed pull just means there is no published tag to prime from yet
+        p.wait()
+
+    # Build the shared CMake helper first; both ubuntu groups copy from it, and
+    # building it once avoids the two concurrent groups racing on its tag
+    cmd = ["docker", "buildx", "bake", "-f", "docker-bake.hcl", "--progress=plain", "cmake"]
+    _print_cmd(cmd)
+    subprocess.check_call(cmd)
+
+    # Build the ubuntu versions concurrently; they share no base images or
+    # layers, so each bake group can run its own build. The contexts in the bake
+    # file still make the base images build before their dependents
+    def build_group(ubuntu_version):
+        group = bake_name(f"ubuntu{ubuntu_version}")
+        cmd = ["docker", "buildx", "bake", "-f", "docker-bake.hcl", "--progress=plain", group]
+        _print_cmd(cmd)
+        subprocess.check_call(cmd)
 
-    cmd=f"DOCKER_BUILDKIT=1 docker-compose build --force-rm --parallel main " + \
-        " ".join([f"gcc{x}" for x in gcc_versions])
-    print(cmd)
-    subprocess.call(cmd, shell=True)
-
-    cmd=f"DOCKER_BUILDKIT=1 docker-compose build --force-rm --parallel " + \
-        " ".join([f"gcc{x}-cuda{y}" for x in gcc_versions for y in nvcc_versions])
-    print(cmd)
-    subprocess.call(cmd, shell=True)
-
-    cmd=f"DOCKER_BUILDKIT=1 docker-compose build --force-rm --parallel " + \
-        " ".join([f"gcc{x}-cuda{y['cuda_ver']}-nvhpc{y['hpc_ver']}" for x in gcc_versions for y in nvhpc_versions])
-    print(cmd)
-    subprocess.call(cmd, shell=True)
-
-    cmd=f"DOCKER_BUILDKIT=1 docker-compose build --force-rm --parallel " + \
-        " ".join([f"clang{x}" for x in clang_versions])
-    print(cmd)
-    subprocess.call(cmd, shell=True)
+    with ThreadPoolExecutor(max_workers=len(service_groups)) as ex:
+        futures = [ex.submit(build_group, uv) for uv in service_groups]
+        # Fail fast: stop waiting on the first group that errors out
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in done:
+            future.result()
 
 
 if __name__ == "__main__":